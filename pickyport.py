@@ -12,15 +12,52 @@ Date: March 22, 2017
 
 """
 import os
+import mmap
 import yaml
+import asyncio
+import shlex
+import shutil
 import argparse
-from tempfile import NamedTemporaryFile
+import threading
+from functools import lru_cache
+from tempfile import NamedTemporaryFile, gettempdir, mkdtemp
 from subprocess import Popen, PIPE
 
+try:
+    import liburing
+except ImportError:
+    liburing = None
 
+try:
+    # libyaml's C loader is much faster than the pure python one
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Size of the reads used when fanning a dump stream out to several destinations
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Character set of the data files written and loaded by direct_path portages
+DIRECT_PATH_CHARSET = 'utf8mb4'
+
+# Configs bigger than this are memory-mapped instead of read through a file buffer
+MMAP_CONFIG_SIZE = 1024 * 1024
+
+# Phases whose statements are sent to a client session on each destination,
+# rather than run as commands of their own. The sessions only last for their phase
+SESSION_PHASES = ('grant', 'update')
+
+# Flags for every mysqldump: read a consistent InnoDB snapshot without locking, stream rows
+# instead of buffering whole tables, and write multi-row INSERTs of up to 1MB each
+DUMP_FLAGS = ['--lock-tables=false', '--single-transaction', '--quick', '--max-allowed-packet=1G',
+              '--net-buffer-length=1048576', '--extended-insert']
+
+
+@lru_cache(maxsize=None)
 def which(program):
     """
     Utility method for finding a given executable, similar to the unix 'which' util.
+    The result is cached, so PATH is only searched once per program.
     http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python/377028#377028
     """
 
@@ -41,6 +78,106 @@ def which(program):
     return None
 
 
+def read_in_background(stream):
+    """
+    Reads a stream to its end on a thread of its own, so the process writing
+    to it never blocks on a full pipe while nobody is reading
+    :param stream: the stream to read, e.g. the stderr of a process
+    :return:a function which waits for the end of the stream and returns everything read from it
+    """
+    output = []
+    thread = threading.Thread(target=lambda: output.append(stream.read()), daemon=True)
+    thread.start()
+
+    def result():
+        thread.join()
+        stream.close()
+        return output[0] if output else b''
+    return result
+
+
+# Client executables, found once rather than for every portage
+MYSQLDUMP = which('mysqldump')
+MYSQL = which('mysql')
+
+
+class IoUringRunner(object):
+    """
+    Submits batches of pipe writes through a single io_uring, so that a batch
+    costs one system call instead of one per operation. Needs Linux 5.6+ and the liburing module.
+    """
+    def __init__(self, entries=64):
+        if liburing is None:
+            raise Exception("Must have the liburing module installed to use the uring I/O backend")
+        self.entries = entries
+        self.ring = liburing.Ring()
+        self.cqe = liburing.Cqe()
+        liburing.io_uring_queue_init(entries, self.ring)
+
+    def close(self):
+        liburing.io_uring_queue_exit(self.ring)
+
+    def wait_completion(self):
+        """
+        Waits for the next completed operation
+        :return:a tuple of the operation's index and its result, which is an OSError if it failed
+        """
+        try:
+            liburing.io_uring_wait_cqe(self.ring, self.cqe)
+            entry = self.cqe[0]
+            result = entry.res
+        except OSError as error:
+            entry = self.cqe[0]
+            result = error
+        index = liburing.io_uring_cqe_get_data64(entry)
+        liburing.io_uring_cqe_seen(self.ring, entry)
+        return index, result
+
+    def run_batch(self, operations):
+        """
+        Submits the operations together and waits for all of them to complete
+        :param operations: list of functions which each prepare one submission queue entry
+        :return:a list with the result of each operation, which is an OSError if it failed
+        """
+        results = [None] * len(operations)
+        for start in range(0, len(operations), self.entries):
+            batch = operations[start:start + self.entries]
+            for index, prepare in enumerate(batch, start):
+                sqe = liburing.io_uring_get_sqe(self.ring)
+                prepare(sqe)
+                liburing.io_uring_sqe_set_data64(sqe, index)
+            liburing.io_uring_submit(self.ring)
+            for _ in batch:
+                index, result = self.wait_completion()
+                results[index] = result
+        return results
+
+    def write_all(self, fds, data):
+        """
+        Writes all of the data to each of the file descriptors
+        :param fds: file descriptors to write to, usually pipes
+        :param data: bytes to write
+        :return:the list of file descriptors which could not be written to
+        """
+        written = dict((fd, 0) for fd in fds)
+        failed = []
+        while written:
+            # Keep a reference to each buffer until its write has completed
+            buffers = [(fd, data[offset:] if offset else data) for fd, offset in written.items()]
+            results = self.run_batch([lambda sqe, fd=fd, buf=buf: liburing.io_uring_prep_write(sqe, fd, buf)
+                                      for fd, buf in buffers])
+            for (fd, _), result in zip(buffers, results):
+                if isinstance(result, OSError):
+                    failed.append(fd)
+                    del written[fd]
+                    continue
+                # Pipe writes can be short, so anything left over goes in the next batch
+                written[fd] += result
+                if written[fd] == len(data):
+                    del written[fd]
+        return failed
+
+
 class BasePorter(object):
     """
     The Porter is the object which creates and runs the necessary commands for porting the source database
@@ -55,20 +192,26 @@ class BasePorter(object):
         self.create_dest_db = False
         self.fetch_data = True
         self.ignore_tables = []
-        self.temp_files = []
+        self.temp_files = set()
+        self.command_temp_files = {}
+        # file descriptors which the commands open through /proc/self/fd
+        self.pass_fds = []
         self.update_scripts = []
+        self.io_backend = 'popen'
 
-    def set_variables(self, port_info, quiet, debug, dry_run):
+    def set_variables(self, port_info, quiet, debug, dry_run, io_backend='popen'):
         """
         :param port_info: source and destination info from the configuration file
         :param quiet: if true, don't print anything to the console
         :param debug: if true, print everything to the console and save temp files
         :param dry_run: if true, just print the commands without actually running them
+        :param io_backend: 'popen' to copy dump data in python, or 'uring' to batch the I/O through io_uring
         :return:
         """
         self.quiet = quiet
         self.debug = debug
         self.dry_run = dry_run
+        self.io_backend = io_backend
 
         self.source = port_info['source']
         self.dest = port_info['dest']
@@ -98,10 +241,31 @@ class BasePorter(object):
         """
         temp_file = NamedTemporaryFile(suffix='.sql', delete=False)
         file_name = temp_file.name
-        self.temp_files.append(file_name)
+        self.temp_files.add(file_name)
         temp_file.close()
         return file_name
 
+    def get_temporary_dir(self, parent_dir=None):
+        """
+        Makes a temporary directory for dumps which are written as several files.
+        :param parent_dir: directory to make it in, or None for the system temp directory
+        :return:The name of the temporary directory
+        """
+        dir_name = mkdtemp(dir=parent_dir)
+        self.temp_files.add(dir_name)
+        return dir_name
+
+    def track_temporary_file(self, temp_file, commands):
+        """
+        Remembers which temp file the commands use, so it can be kept if one of them fails
+        :param temp_file: the temp file or directory used by the commands
+        :param commands: list of (description, command) tuples
+        :return:the commands
+        """
+        for cmd in commands:
+            self.command_temp_files[id(cmd)] = temp_file
+        return commands
+
     def create_db_commands(self):
         """
         Makes the necessary command lines for creating the destination databases
@@ -113,22 +277,35 @@ class BasePorter(object):
         command = "This is the actual command"
         return description, command
 
+    def create_session_command(self, phase, index):
+        """
+        Makes the command line for a client session on a destination database, which
+        reads the statements for the grant and update phases from its stdin
+        :param phase: the phase the session is for, 'grant' or 'update'
+        :param index: index of the destination in self.dest
+        :return:the actual command
+        """
+        command = "This is the actual command"
+        return command
+
     def create_grant_commands(self):
         """
-        Makes the command lines for adding test users to the destination databases
+        Makes the statements for adding test users to the destination databases
         :return:a list of tuples containing:
         * description to print to console
-        * actual command
+        * index of the destination in self.dest
+        * statements to send to the destination's session, as bytes
         """
         commands = []
-        description = "This command creates a user in the destination database"
-        command = "This is the actual command"
-        commands.append((description, command))
+        description = "This statement creates a user in the destination database"
+        statement = b"This is the actual statement"
+        commands.append((description, 0, statement))
         return commands
 
-    def create_dump_command(self, schema_only, sql_file):
+    def create_dump_command(self, schema_only, sql_file=None):
         """
-        Makes the necessary command line for dumping schema and/or data from the source database
+        Makes the necessary command line for dumping schema and/or data from the source database.
+        If sql_file is None, the dump is written to stdout.
         :return:a single tuple containing:
         * description to print to console
         * actual command
@@ -137,12 +314,14 @@ class BasePorter(object):
         command = "This is the actual command"
         return description, command
 
-    def create_load_commands(self, sql_file):
+    def create_load_commands(self, sql_file=None):
         """
-        Makes the necessary command line for loading schema and/or data into the source databases
+        Makes the necessary command line for loading schema and/or data into the source databases.
+        If sql_file is None, the load reads from stdin.
         :return:a list of tuples containing:
         * description to print to console
         * actual command
+        * the sql_file, to send to the command's stdin (only if sql_file is given)
         """
         commands = []
         description = "This loads data and/or tables from the sql_file into the source database"
@@ -152,49 +331,227 @@ class BasePorter(object):
 
     def create_update_commands(self):
         """
-        Makes the necessary command lines for applying updates to the destination databases
+        Makes the statements for applying updates to the destination databases
         :return:a list of tuples containing:
         * description to print to console
-        * actual command
+        * index of the destination in self.dest
+        * statements to send to the destination's session, as bytes
         """
         commands = []
-        description = "This command creates a new database on the destination host"
-        command = "This is the actual command"
-        commands.append((description, command))
+        description = "This statement applies an update script to the destination database"
+        statement = b"This is the actual statement"
+        commands.append((description, 0, statement))
         return commands
 
+    def create_stream_command(self, schema_only):
+        """
+        Makes a command which pipes the dump from the source database straight into
+        the load commands for the destination databases, without a temp file
+        :param schema_only: If true, only stream the schema, not any data
+        :return:a single tuple containing:
+        * description to print to console
+        * a tuple of the dump command and the list of load commands
+        """
+        dump_echo, dump_cmd = self.create_dump_command(schema_only)
+        load_cmds = [load[1] for load in self.create_load_commands()]
+        stream_echo = '%s\nStreaming into %d destination(s)...' % (dump_echo, len(load_cmds))
+        return stream_echo, (dump_cmd, load_cmds)
+
+    def create_port_phases(self, schema_only):
+        """
+        Makes the phases for moving schema and/or data from the source to the destination databases.
+        The dump is streamed directly into the destinations unless in debug mode, where
+        it goes through a temp file which is kept for inspection.
+        :param schema_only: If true, only port the schema, not any data
+        :return:a list of tuples containing:
+        * phase name
+        * list of (description, command) tuples to run in that phase, or a function
+          which makes that list when the phase starts
+        """
+        if not self.debug:
+            return [('stream', [self.create_stream_command(schema_only)])]
+
+        sql_file = self.get_temporary_file()
+        return [('dump', self.track_temporary_file(sql_file, [self.create_dump_command(schema_only, sql_file)])),
+                ('load', self.track_temporary_file(sql_file, self.create_load_commands(sql_file)))]
+
+    @staticmethod
+    def format_command(cmd):
+        """
+        Makes a printable version of a command, including streamed commands
+        :param cmd: a tuple of the description, the command and optionally its stdin, which is either
+        a file name or the SQL itself as bytes. The command is either an argument list or a tuple of
+        the dump command and the list of load commands
+        :return:the command as a string
+        """
+        command = cmd[1]
+        if isinstance(command, tuple):
+            dump_cmd, load_cmds = command
+            return '\n'.join('%s | %s' % (shlex.join(dump_cmd), shlex.join(load_cmd)) for load_cmd in load_cmds)
+        if len(cmd) > 2 and isinstance(cmd[2], bytes):
+            return "%s <<'SQL'\n%sSQL" % (shlex.join(command), cmd[2].decode())
+        if len(cmd) > 2:
+            return '%s < %s' % (shlex.join(command), shlex.quote(cmd[2]))
+        return shlex.join(command)
+
+    def run_stream(self, dump_cmd, load_cmds):
+        """
+        Runs the dump command with its output piped into each of the load commands.
+        A single destination reads straight from the dump pipe; multiple destinations
+        are fed by copying each chunk of the dump to every load process. With the uring
+        I/O backend, the copies of a chunk are written with one io_uring submission.
+        :param dump_cmd: command which writes the dump to stdout
+        :param load_cmds: commands which read the dump from stdin
+        :return:the stderr output of each process which reported an error,
+        each one after the dump command or the pipeline into its destination
+        """
+        dump = Popen(dump_cmd, stdout=PIPE, stderr=PIPE, pass_fds=self.pass_fds)
+        if len(load_cmds) == 1:
+            loads = [Popen(load_cmds[0], stdin=dump.stdout, stderr=PIPE, pass_fds=self.pass_fds)]
+            # Let the load own the read end so the dump gets SIGPIPE if the load dies
+            dump.stdout.close()
+        else:
+            loads = [Popen(load_cmd, stdin=PIPE, stderr=PIPE, pass_fds=self.pass_fds) for load_cmd in load_cmds]
+        # The stderr pipes are only read at the end otherwise, and a process
+        # which fills one up would stop and stall the whole stream
+        errors = [read_in_background(process.stderr) for process in [dump] + loads]
+
+        if len(loads) > 1:
+            receivers = list(loads)
+            runner = IoUringRunner(max(len(loads), 8)) if self.io_backend == 'uring' else None
+            try:
+                for chunk in iter(lambda: dump.stdout.read(STREAM_CHUNK_SIZE), b''):
+                    if runner:
+                        failed = runner.write_all([load.stdin.fileno() for load in receivers], chunk)
+                        # A load which has failed stops receiving, keep feeding the others
+                        receivers = [load for load in receivers if load.stdin.fileno() not in failed]
+                        continue
+                    for load in list(receivers):
+                        try:
+                            load.stdin.write(chunk)
+                        except BrokenPipeError:
+                            # This load has failed, keep feeding the others
+                            receivers.remove(load)
+            finally:
+                if runner:
+                    runner.close()
+            dump.stdout.close()
+            for load in loads:
+                try:
+                    load.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        for process in [dump] + loads:
+            process.wait()
+
+        labels = [shlex.join(dump_cmd)]
+        labels += ['%s | %s' % (shlex.join(dump_cmd), shlex.join(load_cmd)) for load_cmd in load_cmds]
+        output = ''
+        for label, error in zip(labels, errors):
+            error = error().decode(errors='replace')
+            if "ERROR" in error:
+                output += '%s\n%s' % (label, error)
+        return output
+
+    async def run_command(self, cmd):
+        """
+        Runs a single command or streamed command, without going through a shell
+        :param cmd: a tuple of the description, the command and optionally its stdin, which is either
+        a file name or the SQL itself as bytes. The command is either an argument list or a tuple of
+        the dump command and the list of load commands
+        :return:the stderr output of the command
+        """
+        command = cmd[1]
+        if isinstance(command, tuple):
+            # Copying the stream blocks, so it gets a thread of its own
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.run_stream, *command)
+        if len(cmd) > 2 and isinstance(cmd[2], bytes):
+            proc = await asyncio.create_subprocess_exec(*command, stdin=PIPE, stderr=PIPE, pass_fds=self.pass_fds)
+            output = await proc.communicate(cmd[2])
+        elif len(cmd) > 2:
+            with open(cmd[2], 'rb') as input_file:
+                proc = await asyncio.create_subprocess_exec(*command, stdin=input_file, stderr=PIPE,
+                                                            pass_fds=self.pass_fds)
+                output = await proc.communicate()
+        else:
+            proc = await asyncio.create_subprocess_exec(*command, stderr=PIPE, pass_fds=self.pass_fds)
+            output = await proc.communicate()
+        return output[1].decode(errors='replace')
+
+    async def run_phase(self, cmd_list):
+        """
+        Runs all the commands of a phase at the same time
+        :param cmd_list: list of (description, command) tuples
+        :return:the stderr output of each command, in the same order as cmd_list
+        """
+        return await asyncio.gather(*[self.run_command(cmd) for cmd in cmd_list])
+
+    def remove_temp_files(self):
+        """
+        Removes the temp files and directories used during the portage
+        :return:
+        """
+        for tf in self.temp_files:
+            if os.path.isdir(tf):
+                shutil.rmtree(tf)
+            else:
+                os.remove(tf)
+
+    def send_to_session(self, sessions, phase, index, statements):
+        """
+        Sends statements to a destination's session, starting the session if needed.
+        The statements are flushed straight away but not waited on, so the sessions
+        of all the destinations run at the same time.
+        :param sessions: the open sessions, by destination index
+        :param phase: the phase the statements are for, 'grant' or 'update'
+        :param index: index of the destination in self.dest
+        :param statements: the statements, as bytes
+        :return:
+        """
+        if index not in sessions:
+            sessions[index] = Popen(self.create_session_command(phase, index), stdin=PIPE, stderr=PIPE,
+                                    pass_fds=self.pass_fds)
+        try:
+            sessions[index].stdin.write(statements)
+            sessions[index].stdin.flush()
+        except BrokenPipeError:
+            # The session has already stopped, its errors are shown when it is closed
+            pass
+
+    def close_sessions(self, sessions):
+        """
+        Ends the destination sessions once they have run all their statements, and shows any errors
+        :param sessions: the open sessions, by destination index, which are removed as they end
+        :return:
+        """
+        for index in sorted(sessions):
+            session = sessions.pop(index)
+            output = session.communicate()[1].decode(errors='replace')
+            if "ERROR" in output:
+                print(shlex.join(session.args))
+                print(output)
+
     def do_portage(self):
         """
         Main method for creating and running all the commands needed to complete a port
         :return:
         """
-        cmd_list = []
+        phases = []
 
         if self.create_dest_db:
-            cmd_list.extend(self.create_db_commands())
+            phases.append(('create', self.create_db_commands()))
 
         if self.test_users:
-            cmd_list.extend(self.create_grant_commands())
-
-        if self.fetch_data:
-            if self.ignore_tables:
-                schema_file = self.get_temporary_file()
-                data_file = self.get_temporary_file()
-                cmd_list.append(self.create_dump_command(True, schema_file))
-                cmd_list.extend(self.create_load_commands(schema_file))
-                cmd_list.append(self.create_dump_command(False, data_file))
-                cmd_list.extend(self.create_load_commands(data_file))
-            else:
-                schema_data_file = self.get_temporary_file()
-                cmd_list.append(self.create_dump_command(False, schema_data_file))
-                cmd_list.extend(self.create_load_commands(schema_data_file))
-        else:
-            schema_file = self.get_temporary_file()
-            cmd_list.append(self.create_dump_command(True, schema_file))
-            cmd_list.extend(self.create_load_commands(schema_file))
+            phases.append(('grant', self.create_grant_commands()))
+
+        # A single pass gets the schema and, unless only the schema is wanted,
+        # the data of every table that isn't ignored
+        phases.extend(self.create_port_phases(not self.fetch_data))
 
         if self.update_scripts:
-            cmd_list.extend(self.create_update_commands())
+            phases.append(('update', self.create_update_commands()))
 
         if not self.quiet:
             if self.dry_run:
@@ -202,37 +559,76 @@ class BasePorter(object):
             else:
                 print('===============\nStarting portage\n===============')
 
-        for cmd in cmd_list:
+        sessions = {}
+        try:
+            for phase, cmd_list in phases:
+                # Some commands can only be made once the previous phases have run
+                if callable(cmd_list):
+                    cmd_list = cmd_list()
 
-            if not self.quiet:
-                echo = cmd[0]
-                print(echo)
-
-            if self.debug or self.dry_run:
-                print(cmd[1])
-
-            if not self.dry_run:
-                proc = Popen(cmd[1], shell=True, stderr=PIPE)
-                output = proc.communicate()
-                if "ERROR" in output[1]:
-                    # Don't duplicate the print if already in debug mode
-                    if not self.debug:
-                        print(cmd[1])
-                    print(output[1])
-                    # Remove the temp file used in the command from the
-                    # list of temp files so it doesn't get deleted
-                    for tf in self.temp_files:
-                        if tf in cmd[1]:
-                            self.temp_files.remove(tf)
+                if not cmd_list:
+                    continue
 
-            if not self.quiet:
-                print('-------------------\n')
+                if phase in SESSION_PHASES:
+                    # Grants and updates go through a session per destination
+                    for echo, index, statements in cmd_list:
+                        if index in sessions:
+                            # Statements sent to a destination separately get a session of their own,
+                            # so they run in order and an error only stops the batch it is in
+                            self.close_sessions(sessions)
+
+                        if not self.quiet:
+                            print(echo)
+
+                        if self.debug or self.dry_run:
+                            session_cmd = self.create_session_command(phase, index)
+                            print(self.format_command((echo, session_cmd, statements)))
+
+                        if not self.dry_run:
+                            self.send_to_session(sessions, phase, index, statements)
+
+                    # Wait for the statements before going on, rather than leave the sessions
+                    # idle through the dump and load, where they could hit wait_timeout
+                    self.close_sessions(sessions)
+
+                    if not self.quiet:
+                        print('-------------------\n')
+                    continue
+
+                for cmd in cmd_list:
+                    if not self.quiet:
+                        echo = cmd[0]
+                        print(echo)
+
+                    if self.debug or self.dry_run:
+                        print(self.format_command(cmd))
+
+                if not self.dry_run:
+                    # Commands within a phase are independent of each other (one per destination),
+                    # but each phase must finish before the next one starts
+                    outputs = asyncio.run(self.run_phase(cmd_list))
+
+                    for cmd, output in zip(cmd_list, outputs):
+                        if "ERROR" in output:
+                            # Don't duplicate the print if already in debug mode. Streamed
+                            # commands already name the pipeline each error came from
+                            if not self.debug and not isinstance(cmd[1], tuple):
+                                print(self.format_command(cmd))
+                            print(output)
+                            # Remove the temp file used in the command from the
+                            # set of temp files so it doesn't get deleted
+                            self.temp_files.discard(self.command_temp_files.get(id(cmd)))
+
+                if not self.quiet:
+                    print('-------------------\n')
+        finally:
+            # Don't leave sessions behind if a phase fails
+            self.close_sessions(sessions)
 
         if not self.debug:
             if not self.quiet:
                 print('Removing temp files...')
-            for tf in self.temp_files:
-                os.remove(tf)
+            self.remove_temp_files()
 
         if not self.quiet:
             print('Portage complete!\n\n')
@@ -243,28 +639,176 @@ class MySQLPorter(BasePorter):
     The MySQL implementation of the BasePorter class
     """
 
-    def __init__(self, port_info, quiet, debug, dry_run):
+    def __init__(self, port_info, quiet, debug, dry_run, io_backend='popen'):
         """
         :param port_info: source and destination info from the configuration file
         :param quiet: if true, don't print anything to the console
         :param debug: if true, print everything to the console and save temp files
         :param dry_run: if true, just print the commands without actually running them
+        :param io_backend: 'popen' to copy dump data in python, or 'uring' to batch the I/O through io_uring
         :return:
         """
         BasePorter.__init__(self)
-        self.mysqldump = which('mysqldump')
+        self.mysqldump = MYSQLDUMP
         if self.mysqldump is None:
             raise Exception("Must have mysqldump executable in PATH")
-        self.mysql = which('mysql')
-        if self.mysqldump is None:
+        self.mysql = MYSQL
+        if self.mysql is None:
             raise Exception("Must have mysql executable in PATH")
-        self.set_variables(port_info, quiet, debug, dry_run)
+        self.use_direct_path = False
+        self.direct_path_dir = None
+        self.compress = False
+        self.option_files = {}
+        self.dest_clients = None
+        self.set_variables(port_info, quiet, debug, dry_run, io_backend)
+
+        if 'direct_path' in port_info:
+            self.use_direct_path = port_info['direct_path']
+
+        if 'direct_path_dir' in port_info:
+            self.direct_path_dir = port_info['direct_path_dir']
+
+        if 'compress' in port_info:
+            self.compress = port_info['compress']
+
+        # Every dump skips the same tables, so only build their flags once
+        self.ignored_table_flags = ['--ignore-table=%s.%s' % (self.source['name'], ignore)
+                                    for ignore in self.ignore_tables]
+
+    def get_option_file(self, connection):
+        """
+        Makes a client option file with the credentials for a connection, so they
+        aren't passed on the command line where anyone can see them with ps.
+        Debug runs use named files, so the commands they show can be run again.
+        Dry runs don't write the credentials anywhere, and only show a placeholder.
+        :param connection: the source or a destination from the configuration file
+        :return:The name of the option file, for --defaults-extra-file
+        """
+        key = (connection['host'], connection['user'], connection['password'])
+        if key in self.option_files:
+            return self.option_files[key]
+
+        if self.dry_run:
+            self.option_files[key] = '<option file for %s@%s>' % (connection['user'], connection['host'])
+            return self.option_files[key]
+
+        password = str(connection['password']).replace('\\', '\\\\').replace('"', '\\"')
+        options = '[client]\nhost=%s\nuser=%s\npassword="%s"\n' % (connection['host'],
+                                                                     connection['user'],
+                                                                     password)
+        fd = None
+        # /proc/self/fd paths only mean something inside this process,
+        # so debug runs, which show the commands, use a named file
+        if not self.debug:
+            try:
+                # An anonymous file never shows up in the filesystem and the kernel
+                # frees it when pickyport exits, even if it crashes
+                fd = os.open(gettempdir(), os.O_TMPFILE | os.O_RDWR, 0o600)
+            except (AttributeError, OSError):
+                # O_TMPFILE is Linux only, and not every filesystem supports it
+                pass
+
+        if fd is None:
+            # NamedTemporaryFile is only readable by the current user
+            option_file = NamedTemporaryFile(mode='w', suffix='.cnf', delete=False)
+            option_file.write(options)
+            option_file.close()
+            self.option_files[key] = option_file.name
+        else:
+            os.write(fd, options.encode())
+            self.pass_fds.append(fd)
+            self.option_files[key] = '/proc/self/fd/%d' % fd
+        return self.option_files[key]
+
+    def get_client_command(self, program, connection):
+        """
+        Starts the command line for a mysql client program which connects to the given database host
+        :param program: the client executable, e.g. self.mysql
+        :param connection: the source or a destination from the configuration file
+        :return:a list with the executable and its credentials option
+        """
+        return [program, '--defaults-extra-file=%s' % self.get_option_file(connection)]
+
+    def get_dest_clients(self):
+        """
+        Gets the start of the mysql command line for each destination. Every mysql command
+        for a destination starts the same way, so this is only built once per portage.
+        :return:a list of tuples of the destination and its client command
+        """
+        if self.dest_clients is None:
+            self.dest_clients = [(dest, self.get_client_command(self.mysql, dest)) for dest in self.dest]
+        return self.dest_clients
+
+    def do_portage(self):
+        """
+        Runs the portage, then removes the option files with the credentials. Debug runs
+        keep them, like the other temp files, so the commands they show can be run again.
+        :return:
+        """
+        try:
+            BasePorter.do_portage(self)
+        finally:
+            for (host, user, _), option_file in self.option_files.items():
+                if self.dry_run or option_file.startswith('/proc/self/fd/'):
+                    continue
+                if self.debug:
+                    if not self.quiet:
+                        print('Credentials for %s@%s kept in %s' % (user, host, option_file))
+                else:
+                    os.remove(option_file)
+            for fd in self.pass_fds:
+                os.close(fd)
+            self.option_files = {}
+            self.pass_fds = []
+            # The client commands point at the option files, so they go too
+            self.dest_clients = None
+
+    def get_transfer_flags(self):
+        """
+        Gets the client flags for the commands which move the dumped data across the network
+        :return:a list of flags
+        """
+        if self.compress:
+            # compress the client/server protocol on both the dump and load connections
+            return ['--compress']
+        return []
 
-    def create_dump_command(self, schema_only, output_file):
+    def create_port_phases(self, schema_only):
+        """
+        Makes the phases for porting the source database. With use_direct_path, the data is dumped
+        as one tab-separated file per table and bulk loaded with LOAD DATA LOCAL INFILE, after the
+        schema has been ported on its own.
+        :param schema_only: If true, only port the schema, not any data
+        :return:a list of tuples containing:
+        * phase name
+        * list of (description, command) tuples to run in that phase, or a function
+          which makes that list when the phase starts
+        """
+        if schema_only or not self.use_direct_path:
+            return BasePorter.create_port_phases(self, schema_only)
+
+        # The data files don't create the tables, so port them first
+        phases = BasePorter.create_port_phases(self, True)
+
+        if self.dry_run:
+            # Nothing is dumped, so there is no need for a real directory
+            tab_dir = os.path.join(self.direct_path_dir or gettempdir(), '<temp dir>')
+        else:
+            tab_dir = self.get_temporary_dir(self.direct_path_dir)
+            # mysqldump --tab has the source server write the data files, so it needs write access.
+            # Other users can't list the directory, and the sticky bit stops them from removing
+            # or renaming files they don't own
+            os.chmod(tab_dir, 0o1733)
+        phases.append(('dump', self.track_temporary_file(tab_dir, [self.create_direct_dump_command(tab_dir)])))
+        # The data files are only known once the dump has run
+        phases.append(('load', lambda: self.track_temporary_file(tab_dir, self.create_direct_load_commands(tab_dir))))
+        return phases
+
+    def create_dump_command(self, schema_only, output_file=None):
         """
         Creates the mysqldump command for getting data and/or schema out of the source database
         :param schema_only: If true, only get the schema, not any data
-        :param output_file: File for storing the dumped schema and data
+        :param output_file: File for storing the dumped schema and data, or None to dump to stdout
         :return:a single tuple containing:
         * description to print to console
         * actual command
@@ -272,52 +816,126 @@ class MySQLPorter(BasePorter):
         if schema_only:
             # this will get all the CREATE TABLE
             # information without adding any data rows
-            data_flag = '--no-data'
+            data_flags = ['--no-data']
             dump_type = 'empty schema'
-        elif self.ignore_tables:
-            # this leaves out the create table info so the
-            # data rows are bulk inserted into the pre-existing table
-            data_flag = '--no-create-info --complete-insert'
-            dump_type = 'selected data'
         else:
-            # this will get the CREATE TABLE info and all the data at once
-            data_flag = '--complete-insert'
-            dump_type = 'all tables and data'
-
-        ignored_tables = ''
-        for ignore in self.ignore_tables:
-            ignored_tables += '--ignore-table=%s.%s ' % (self.source['name'], ignore)
-
-        dump_cmd = '%s --lock-tables=false --routines=true %s %s --result-file=%s ' % (self.mysqldump,
-                                                                                       data_flag,
-                                                                                       ignored_tables,
-                                                                                       output_file)
-        dump_cmd += '-h%s -u%s -p%s %s' % (self.source['host'],
-                                           self.source['user'],
-                                           self.source['password'],
-                                           self.source['name'])
+            # this will get the CREATE TABLE info and all the data at once,
+            # so the column order always matches and --complete-insert isn't needed.
+            # Each table's rows are loaded in a single transaction instead of committing
+            # every INSERT; the dump already turns off unique and foreign key checks
+            data_flags = ['--no-autocommit']
+            dump_type = 'selected tables and data' if self.ignore_tables else 'all tables and data'
+
+        result_file = []
+        if output_file:
+            result_file = ['--result-file=%s' % output_file]
+
+        dump_cmd = self.get_client_command(self.mysqldump, self.source)
+        dump_cmd += DUMP_FLAGS + ['--routines=true'] + data_flags + self.ignored_table_flags + result_file
+        dump_cmd += self.get_transfer_flags() + [self.source['name']]
         dump_echo = 'Dumping %s from %s.%s...' % (dump_type, self.source['host'], self.source['name'])
         return dump_echo, dump_cmd
 
-    def create_load_commands(self, input_file):
+    def create_direct_dump_command(self, tab_dir):
+        """
+        Creates the mysqldump command for dumping the data of each table in the source database into
+        a tab-separated file. The source server writes these files itself, so this only works when
+        tab_dir is on the source database host.
+        :param tab_dir: Directory for storing the dumped data files
+        :return:a single tuple containing:
+        * description to print to console
+        * actual command
+        """
+        dump_cmd = self.get_client_command(self.mysqldump, self.source)
+        dump_cmd += DUMP_FLAGS + ['--routines=false', '--skip-triggers', '--no-create-info']
+        # The data files are loaded with the same character set they are written in
+        dump_cmd += ['--default-character-set=%s' % DIRECT_PATH_CHARSET]
+        dump_cmd += self.ignored_table_flags + ['--tab=%s' % tab_dir]
+        dump_cmd += self.get_transfer_flags() + [self.source['name']]
+        dump_echo = 'Dumping data files from %s.%s...' % (self.source['host'], self.source['name'])
+        return dump_echo, dump_cmd
+
+    def get_source_tables(self):
+        """
+        Asks the source database for its tables, leaving out views and the ignored tables
+        :return:a list of table names, or None if they couldn't be listed
+        """
+        list_cmd = self.get_client_command(self.mysql, self.source)
+        list_cmd += ['--batch', '--skip-column-names', '--raw']
+        list_cmd += ['-e', "SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'", self.source['name']]
+        proc = Popen(list_cmd, stdout=PIPE, stderr=PIPE, pass_fds=self.pass_fds)
+        output, errors = proc.communicate()
+        if proc.returncode:
+            print(shlex.join(list_cmd))
+            print(errors.decode(errors='replace'))
+            return None
+        tables = [line.split(b'\t')[0].decode() for line in output.splitlines()]
+        return [table for table in tables if table not in self.ignore_tables]
+
+    def create_direct_load_commands(self, tab_dir):
+        """
+        Creates the mysql commands for bulk loading the data files written by
+        mysqldump --tab into the destination databases. Only the data files of the
+        source's tables are loaded, whatever else may have turned up in tab_dir.
+
+        :param tab_dir: Directory with a <table>.txt data file for each table
+        :return:a list of tuples containing:
+        * description to print to console
+        * actual command
+        * the load statements, as bytes, to send to the command's stdin
+        """
+        if self.dry_run:
+            # The dump hasn't run, so just show the statement used for each table
+            tables = ['<table>']
+            tables_echo = 'the data file of each table'
+        else:
+            source_tables = self.get_source_tables()
+            if source_tables is None:
+                print("ERROR: could not list the tables of %s.%s" % (self.source['host'], self.source['name']))
+                return []
+            tables = sorted(table for table in source_tables if os.path.isfile(os.path.join(tab_dir, table + '.txt')))
+            tables_echo = '%d data files' % len(tables)
+        # Load everything in one transaction without per-row constraint checks. This trades
+        # durability for speed, which is fine for the new or emptied databases being loaded
+        load_sql = 'SET autocommit=0;\nSET FOREIGN_KEY_CHECKS=0;\nSET UNIQUE_CHECKS=0;\n'
+        for table in tables:
+            data_file = os.path.join(tab_dir, table + '.txt').replace('\\', '\\\\').replace("'", "\\'")
+            load_sql += "LOAD DATA LOCAL INFILE '%s' INTO TABLE `%s` CHARACTER SET %s;\n" % (
+                data_file, table.replace('`', '``'), DIRECT_PATH_CHARSET)
+        load_sql += 'COMMIT;\n'
+        # A statement per table soon outgrows the limit on the size of a single
+        # command line argument, so the statements go through stdin
+        load_sql = load_sql.encode()
+
+        load_flags = ['--local-infile=1'] + self.get_transfer_flags()
+        load_commands = []
+        for dest, client_cmd in self.get_dest_clients():
+            load_cmd = client_cmd + load_flags + [dest['name']]
+            load_echo = 'Loading %s on %s.%s...' % (tables_echo, dest['name'], dest['host'])
+            load_commands.append((load_echo, load_cmd, load_sql))
+
+        return load_commands
+
+    def create_load_commands(self, input_file=None):
         """
         Creates the mysql commands for loading data and/or schema into the destination databases
 
-        :param input_file: File with the data or schema to load
+        :param input_file: File with the data or schema to load, or None to load from stdin
         :return:a list of tuples containing:
         * description to print to console
         * actual command
+        * the input_file, to send to the command's stdin (only if input_file is given)
         """
+        transfer_flags = self.get_transfer_flags()
         load_commands = []
-        for dest in self.dest:
-            load_cmd = ('%s -h%s -u%s -p%s %s < %s' % (self.mysql,
-                                                       dest['host'],
-                                                       dest['user'],
-                                                       dest['password'],
-                                                       dest['name'],
-                                                       input_file))
-            load_echo = 'Loading %s on %s.%s...' % (input_file, dest['name'], dest['host'])
-            load_commands.append((load_echo, load_cmd))
+        for dest, client_cmd in self.get_dest_clients():
+            load_cmd = client_cmd + transfer_flags + [dest['name']]
+            if input_file:
+                load_echo = 'Loading %s on %s.%s...' % (input_file, dest['name'], dest['host'])
+                load_commands.append((load_echo, load_cmd, input_file))
+            else:
+                load_echo = 'Loading dump stream on %s.%s...' % (dest['name'], dest['host'])
+                load_commands.append((load_echo, load_cmd))
 
         return load_commands
 
@@ -329,25 +947,37 @@ class MySQLPorter(BasePorter):
         * actual command
         """
         create_commands = []
-        for dest in self.dest:
+        for dest, client_cmd in self.get_dest_clients():
             create_sql = 'DROP DATABASE IF EXISTS %s; CREATE DATABASE %s;' % (dest['name'], dest['name'])
-            create_cmd = "%s -h%s -u%s -p%s -e '%s'" % (self.mysql,
-                                                        dest['host'],
-                                                        dest['user'],
-                                                        dest['password'],
-                                                        create_sql)
+            create_cmd = client_cmd + ['-e', create_sql]
             create_echo = 'Creating %s on %s...' % (dest['name'], dest['host'])
             create_commands.append((create_echo, create_cmd))
         return create_commands
 
+    def create_session_command(self, phase, index):
+        """
+        Creates the mysql command for a session on a destination database, which runs
+        the grant and update statements as they are sent to its stdin. The grant session
+        runs with --force, so a failed grant is reported and the grants after it still run.
+        Update sessions stop at the first error, like mysql db < script would.
+        :param phase: the phase the session is for, 'grant' or 'update'
+        :param index: index of the destination in self.dest
+        :return:the actual command
+        """
+        dest, client_cmd = self.get_dest_clients()[index]
+        force = ['--force'] if phase == 'grant' else []
+        return client_cmd + force + [dest['name']]
+
     def create_grant_commands(self):
         """
-        Creates the mysql command for adding test users to the destination databases
+        Creates the statements for adding test users to the destination databases.
+        All the grants for a destination are sent to its session together.
         :return:a list of tuple containing:
         * description to print to console
-        * actual command
+        * index of the destination in self.dest
+        * the grant statements, as bytes
         """
-        grant_commands = []
+        user_permissions = []
         for test_user in self.test_users:
             if test_user['permissions'] == 'write':
                 permissions = 'SELECT, INSERT, UPDATE, DELETE, EXECUTE'
@@ -355,46 +985,51 @@ class MySQLPorter(BasePorter):
                 permissions = 'ALL'
             else:
                 permissions = 'SELECT'
-            for dest in self.dest:
-
-                grant_sql = "GRANT %s on %s.* to '%s'@'%%' IDENTIFIED BY '%s'; FLUSH PRIVILEGES;" % (permissions,
-                                                                                                     dest['name'],
-                                                                                                     test_user['user'],
-                                                                                                     test_user['password'])
-                grant_cmd = '%s -h%s -u%s -p%s -e "%s"' % (self.mysql,
-                                                           dest['host'],
-                                                           dest['user'],
-                                                           dest['password'],
-                                                           grant_sql)
-
-                grant_echo = "Granting %s %s permission on %s.%s..." % (test_user['user'],
-                                                                        test_user['permissions'],
-                                                                        dest['host'],
-                                                                        dest['name'])
-                grant_commands.append((grant_echo, grant_cmd))
+            user_permissions.append((test_user, permissions))
+
+        grant_commands = []
+        for index, dest in enumerate(self.dest):
+            grant_sql = ''
+            grant_echo = []
+            for test_user, permissions in user_permissions:
+                grant_sql += "GRANT %s on %s.* to '%s'@'%%' IDENTIFIED BY '%s';\n" % (permissions,
+                                                                                      dest['name'],
+                                                                                      test_user['user'],
+                                                                                      test_user['password'])
+                grant_echo.append("Granting %s %s permission on %s.%s..." % (test_user['user'],
+                                                                             test_user['permissions'],
+                                                                             dest['host'],
+                                                                             dest['name']))
+            grant_sql += 'FLUSH PRIVILEGES;\n'
+            grant_commands.append(('\n'.join(grant_echo), index, grant_sql.encode()))
         return grant_commands
 
     def create_update_commands(self):
         """
-        Makes the mysql command lines for applying updates to the destination databases
-        :return:a list of tuples containing:
+        Makes the statements for applying updates to the destination databases.
+        Each update script is sourced by a session of its own, so a failed script stops
+        where it failed without keeping the later scripts from running.
+        :return:a list of tuples, in the order the scripts are applied, containing:
         * description to print to console
-        * actual command
+        * index of the destination in self.dest
+        * the source statement for the update script, as bytes
         """
-        update_commands = []
+        update_scripts = []
         for update in self.update_scripts:
             if not os.path.isfile(update):
                 print("ERROR: %s does not exist!" % update)
                 continue
-            for dest in self.dest:
-                create_cmd = "%s -h%s -u%s -p%s %s < %s" % (self.mysql,
-                                                            dest['host'],
-                                                            dest['user'],
-                                                            dest['password'],
-                                                            dest['name'],
-                                                            update)
-                create_echo = 'Applying %s to %s.%s...' % (update, dest['host'], dest['name'])
-                update_commands.append((create_echo, create_cmd))
+            update_scripts.append(update)
+
+        if not update_scripts:
+            return []
+
+        update_commands = []
+        for update in update_scripts:
+            update_sql = 'source %s\n' % os.path.abspath(update)
+            for index, dest in enumerate(self.dest):
+                update_echo = 'Applying %s to %s.%s...' % (update, dest['host'], dest['name'])
+                update_commands.append((update_echo, index, update_sql.encode()))
         return update_commands
 
 
@@ -410,18 +1045,29 @@ def get_argument_parser():
                             default=False, action='store_true')
     arg_parser.add_argument('-d', '--dry-run', help='show commands without running them', required=False,
                             default=False, action='store_true')
+    arg_parser.add_argument('--io-backend', help='how dump data is copied to multiple destinations: '
+                                                 'popen (default) or uring (Linux io_uring, needs liburing)',
+                            required=False, default='popen', choices=['popen', 'uring'])
     return arg_parser
 
 
 if __name__ == '__main__':
     parser = get_argument_parser()
     args = parser.parse_args()
+    if args.io_backend == 'uring' and liburing is None:
+        # Fail before anything is done to the destinations
+        parser.error('the uring I/O backend needs the liburing module')
     config_file = args.config
     if not os.path.isfile(config_file):
         print(config_file + " not found")
     else:
         try:
-            cfg = yaml.safe_load(open(config_file, 'r'))
+            with open(config_file, 'rb') as config:
+                if os.fstat(config.fileno()).st_size > MMAP_CONFIG_SIZE:
+                    with mmap.mmap(config.fileno(), 0, access=mmap.ACCESS_READ) as config_map:
+                        cfg = yaml.load(config_map, Loader=SafeLoader)
+                else:
+                    cfg = yaml.load(config, Loader=SafeLoader)
 
             if args.debug:
                 from pprint import pprint
@@ -430,7 +1076,7 @@ if __name__ == '__main__':
             for portage in cfg['portages']:
 
                 if 'db_type' not in portage or portage['db_type'] == 'mysql':
-                    porter = MySQLPorter(portage, args.quiet, args.debug, args.dry_run)
+                    porter = MySQLPorter(portage, args.quiet, args.debug, args.dry_run, args.io_backend)
                 else:
                     print("Only MySQL portages supported")
                     continue